@@ -2,18 +2,22 @@
 """
 Human Voice Detection and Anonymisation Script
 Uses BirdNET to detect human voices and zeros out those segments.
+Progress is journalled per site, so an interrupted run resumes where it stopped.
 """
 
 import subprocess
-import shutil
-import wave
-import numpy as np
 import os
 import argparse
 import pandas as pd
 import logging
+import json
 from pathlib import Path
-import glob
+import audio_io
+import dedup
+import pipeline
+import staging
+
+JOURNAL_NAME = "anonymise_journal.jsonl"
 
 def setup_logging(verbose=False):
     """Set up logging with console and file handlers based on verbosity."""
@@ -45,6 +49,13 @@ def setup_logging(verbose=False):
     
     logger.addHandler(console_handler)
     
+    # Send messages from the pipeline and staging modules to the same handlers
+    for name in ("pipeline", "staging"):
+        library_logger = logging.getLogger(name)
+        library_logger.setLevel(logging.INFO)
+        library_logger.handlers = [file_handler, console_handler]
+        library_logger.propagate = False
+    
     return logger
 
 def print_progress(message, verbose=False):
@@ -52,47 +63,30 @@ def print_progress(message, verbose=False):
     if not verbose:
         print(message)
 
-def create_slist():
-    """Create a species list file containing only human vocal entries."""
-    filename = "species_list.txt"
-    with open(filename, "w") as file:
-        file.write("Human vocal_Human vocal")
-    logger.info(f"Created species list file: {filename}")
-    return filename
-
-def run_birdnet_batch(input_dir, output_dir, threads, slist, min_conf, verbose=False):
-    """Run BirdNET analysis on entire directory."""
+def run_birdnet_batch(input_dir, source_dir, threads, min_conf, verbose=False, files=None):
+    """
+    Run BirdNET analysis on entire directory, or only on files if given.
+    Returns the detections as a DataFrame, or None if BirdNET failed.
+    """
     try:
-        command = [
-            "python", "-m", "birdnet_analyzer.analyze",
-            str(input_dir),
-            "-o", str(output_dir),
-            "--threads", str(threads), 
-            "--combine_results", 
-            "--slist", str(slist), 
-            "--min_conf", str(min_conf), 
-            "--rtype", "csv"
-        ]
-
         logger.info(f"Running BirdNET on: {input_dir}")
         if not verbose:
             print_progress(f"  Running BirdNET analysis...", verbose)
         
-        result = subprocess.run(command, capture_output=True, text=True, check=True)
+        df = pipeline.detect_voices(input_dir, threads, min_conf, files=files, source_path=source_dir)
         logger.info(f"BirdNET analysis completed")
         if not verbose:
             print_progress(f"  BirdNET analysis completed", verbose)
-        return True
+        return df
         
-    except subprocess.CalledProcessError as e:
+    except (subprocess.CalledProcessError, FileNotFoundError) as e:
         logger.error(f"BirdNET failed: {e}")
-        logger.error(f"stderr: {e.stderr}")
         if not verbose:
             print(f"  ERROR: BirdNET analysis failed")
-        return False
+        return None
 
 def parse_results(results_file):
-    """Parse BirdNET results to get human voice detections by file."""
+    """Parse a saved BirdNET results file to get human voice detections by file."""
     try:
         # Check if file exists
         if not os.path.exists(results_file):
@@ -102,42 +96,7 @@ def parse_results(results_file):
         # Read the CSV with comma separator (based on your header format)
         df = pd.read_csv(results_file, sep=',')
         logger.info(f"Successfully parsed CSV. Columns: {list(df.columns)}")
-        logger.info(f"Number of rows: {len(df)}")
-        
-        # Check if file is empty
-        if len(df) == 0:
-            logger.info("Results file is empty - no detections found")
-            return {}
-        
-        # Verify we have the expected columns
-        required_columns = ['Start (s)', 'End (s)', 'File']
-        missing_columns = [col for col in required_columns if col not in df.columns]
-        if missing_columns:
-            logger.error(f"Missing required columns: {missing_columns}")
-            logger.error(f"Available columns: {list(df.columns)}")
-            return {}
-        
-        # Parse the detections
-        file_detections = {}
-        for _, row in df.iterrows():
-            try:
-                filename = row['File']
-                start_time = float(row['Start (s)'])
-                end_time = float(row['End (s)'])
-                
-                if filename not in file_detections:
-                    file_detections[filename] = []
-                file_detections[filename].append((start_time, end_time))
-            except Exception as row_error:
-                logger.warning(f"Error processing row: {row_error}")
-                continue
-        
-        logger.info(f"Found human voice detections in {len(file_detections)} files")
-        if file_detections:
-            for filename, segments in file_detections.items():
-                logger.info(f"  {filename}: {len(segments)} segments")
-        
-        return file_detections
+        return get_detections(df)
         
     except Exception as e:
         logger.error(f"Error parsing results file {results_file}: {e}")
@@ -145,133 +104,140 @@ def parse_results(results_file):
         logger.error(f"Traceback: {traceback.format_exc()}")
         return {}
 
-def zero_segments(input_wav, output_wav, segments, verbose=False):
-    """Zero out segments in a WAV file where human voices were detected."""
-    try:
-        logger.info(f"=== ZEROING SEGMENTS DEBUG ===")
-        logger.info(f"Input: {input_wav}")
-        logger.info(f"Output: {output_wav}")
-        logger.info(f"Segments to zero: {segments}")
-        
-        if not segments:
-            logger.info(f"No human voice segments found in {input_wav}")
-            if str(input_wav) != str(output_wav):
-                shutil.copy2(input_wav, output_wav)
-            return True
-        
-        # Read WAV file
-        with wave.open(str(input_wav), 'rb') as wav_in:
-            params = wav_in.getparams()
-            framerate = wav_in.getframerate()
-            nchannels = wav_in.getnchannels()
-            sampwidth = wav_in.getsampwidth()
-            nframes = wav_in.getnframes()
-            frames = wav_in.readframes(nframes)
+def get_detections(df):
+    """Get human voice detections by file from BirdNET results."""
+    logger.info(f"Number of rows: {len(df)}")
+    
+    # Check if file is empty
+    if len(df) == 0:
+        logger.info("Results file is empty - no detections found")
+        return {}
+    
+    # Verify we have the expected columns
+    required_columns = ['Start (s)', 'End (s)', 'File']
+    missing_columns = [col for col in required_columns if col not in df.columns]
+    if missing_columns:
+        logger.error(f"Missing required columns: {missing_columns}")
+        logger.error(f"Available columns: {list(df.columns)}")
+        return {}
+    
+    file_detections = pipeline.voice_segments(df)
+    
+    logger.info(f"Found human voice detections in {len(file_detections)} files")
+    if file_detections:
+        for filename, segments in file_detections.items():
+            logger.info(f"  {filename}: {len(segments)} segments")
+    
+    return file_detections
 
-        logger.info(f"WAV params: {framerate}Hz, {nchannels}ch, {sampwidth}bytes/sample, {nframes}frames, duration={nframes/framerate:.2f}s")
-        
-        # Verify it's mono
-        if nchannels != 1:
-            logger.error(f"Expected mono audio, got {nchannels} channels")
-            return False
-        
-        # Convert to numpy array
-        if sampwidth == 2:
-            dtype = np.int16
-            zero_value = 0
-        elif sampwidth == 1:
-            dtype = np.uint8
-            zero_value = 128
-        elif sampwidth == 4:
-            dtype = np.int32
-            zero_value = 0
-        else:
-            logger.error(f"Unsupported sample width: {sampwidth}")
-            return False
-        
-        audio = np.frombuffer(frames, dtype=dtype).copy()
-        logger.info(f"Audio array: {len(audio)} samples, dtype={dtype}")
-        
-        # Show some sample values before modification
-        logger.info(f"First 10 samples: {audio[:10]}")
-        if len(audio) > 10:
-            logger.info(f"Sample around middle: {audio[len(audio)//2-5:len(audio)//2+5]}")
-        
-        # Process each segment
-        total_samples_zeroed = 0
-        for i, (start_time, end_time) in enumerate(segments):
-            logger.info(f"--- Processing segment {i+1}: {start_time:.3f}s to {end_time:.3f}s ---")
-            
-            # Calculate sample indices
-            start_sample = int(start_time * framerate)
-            end_sample = int(end_time * framerate)
-            
-            logger.info(f"Sample range: {start_sample} to {end_sample}")
-            logger.info(f"Duration in samples: {end_sample - start_sample}")
-            
-            # Clamp to valid range
-            start_sample = max(0, start_sample)
-            end_sample = min(len(audio), end_sample)
-            
-            if start_sample >= end_sample:
-                logger.warning(f"Invalid segment: start_sample {start_sample} >= end_sample {end_sample}")
-                continue
-                
-            if start_sample >= len(audio):
-                logger.warning(f"Segment starts beyond audio length: {start_sample} >= {len(audio)}")
+def load_journal(journal_file):
+    """
+    Read a site's anonymisation journal.
+
+    The journal is a JSON lines file next to human_voices.csv. Its first line records the detection settings,
+    the recordings that were analysed and the duplicates that got the detections of their canonical copy. Later
+    lines record recordings analysed later, finished stages and every file that was rewritten. Recordings and
+    outputs are stored with their size and modification time so changed files are processed again.
+    """
+    journal = {'minconf': None, 'dedup': None, 'stage': None, 'analysed': {}, 'duplicates': {}, 'files': {}}
+    if not Path(journal_file).exists():
+        return journal
+    with open(journal_file, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # The last line may be incomplete if the run was killed while writing it
+                logger.warning(f"Ignoring unreadable journal line in {journal_file}")
                 continue
-            
-            # Show values before zeroing
-            logger.info(f"Before zeroing - samples {start_sample} to {start_sample+5}: {audio[start_sample:start_sample+5]}")
-            
-            # ZERO THE SEGMENT
-            audio[start_sample:end_sample] = zero_value
-            
-            # Show values after zeroing
-            logger.info(f"After zeroing - samples {start_sample} to {start_sample+5}: {audio[start_sample:start_sample+5]}")
-            
-            samples_zeroed = end_sample - start_sample
-            total_samples_zeroed += samples_zeroed
-            logger.info(f"Zeroed {samples_zeroed} samples ({samples_zeroed/framerate:.3f} seconds)")
-        
-        logger.info(f"=== TOTAL: {total_samples_zeroed} samples zeroed across {len(segments)} segments ===")
-        
-        if not verbose:
-            if segments:
-                print_progress(f"    Processed {Path(input_wav).name} - zeroed {len(segments)} segments", verbose)
-            # Don't print anything for files with no segments to reduce clutter
-        
-        # Write the modified audio
-        with wave.open(str(output_wav), 'wb') as wav_out:
-            wav_out.setparams(params)
-            wav_out.writeframes(audio.tobytes())
-        
-        logger.info(f"Written modified audio to: {output_wav}")
-        
-        # Verify the output file was created and has the right size
-        if os.path.exists(output_wav):
-            output_size = os.path.getsize(output_wav)
-            input_size = os.path.getsize(input_wav)
-            logger.info(f"Output file size: {output_size} bytes (input was {input_size} bytes)")
-        else:
-            logger.error(f"Output file was not created: {output_wav}")
-            return False
-        
-        return True
-        
-    except Exception as e:
-        logger.error(f"Error processing {input_wav}: {e}")
-        if not verbose:
-            print(f"    ERROR processing {Path(input_wav).name}")
-        import traceback
-        logger.error(f"Traceback: {traceback.format_exc()}")
+            if 'minconf' in entry:
+                journal['minconf'] = entry['minconf']
+                journal['dedup'] = entry.get('dedup')
+            if 'analysed' in entry:
+                journal['analysed'].update(entry['analysed'])
+                # Recordings that were analysed again are only duplicates if this entry says so
+                for file in entry['analysed']:
+                    journal['duplicates'].pop(file, None)
+                journal['duplicates'].update(entry.get('duplicates', {}))
+            if 'stage' in entry:
+                journal['stage'] = entry['stage']
+            if 'file' in entry:
+                journal['files'][entry['file']] = entry
+    return journal
+
+def _append_journal(journal_file, entry):
+    with open(journal_file, "a", encoding="utf-8") as f:
+        f.write(json.dumps(entry) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+def file_stats(files):
+    """Return {file: [size, mtime]} for a list of recordings."""
+    stats = {}
+    for file in files:
+        stat = Path(file).stat()
+        stats[str(file)] = [stat.st_size, stat.st_mtime]
+    return stats
+
+def start_journal(journal_file, minconf, dedup, analysed, duplicates):
+    """
+    Start a new journal once detection has finished for a site. analysed is file_stats of the recordings and
+    duplicates is {duplicate: canonical} for the recordings that were not analysed themselves.
+    """
+    Path(journal_file).unlink(missing_ok=True)
+    _append_journal(journal_file, {'minconf': minconf, 'dedup': dedup, 'stage': "detected", 'analysed': analysed,
+                                   'duplicates': duplicates})
+
+def journal_detected(journal_file, analysed, duplicates):
+    """Record that detection finished for recordings that were added or changed after the journal was started."""
+    _append_journal(journal_file, {'stage': "detected", 'analysed': analysed, 'duplicates': duplicates})
+
+def unanalysed_files(journal, files):
+    """
+    Return the recordings that are not in the journal's analysed list or changed since they were analysed.
+    Files that an earlier run rewrote (e.g. with --overwrite) count as analysed.
+    """
+    outputs = {entry['output'] for entry in journal['files'].values() if file_done(entry)}
+    stats = file_stats(file for file in files if file not in outputs)
+    return [file for file, stat in stats.items() if journal['analysed'].get(file) != stat]
+
+def journal_stage(journal_file, stage):
+    """Record that a site reached a stage."""
+    _append_journal(journal_file, {'stage': stage})
+
+def journal_file_done(journal_file, source_file, output_file):
+    """Record that a file was rewritten, with the size and modification time of the output."""
+    stat = Path(output_file).stat()
+    _append_journal(journal_file, {'file': str(source_file), 'output': str(output_file),
+                                   'size': stat.st_size, 'mtime': stat.st_mtime})
+
+def file_done(entry):
+    """Check whether a journal entry's output still exists unchanged."""
+    if entry is None:
         return False
+    try:
+        stat = Path(entry['output']).stat()
+    except OSError:
+        return False
+    return stat.st_size == entry['size'] and stat.st_mtime == entry['mtime']
+
+def get_audio_files(path):
+    """Get all WAV and FLAC files from a directory."""
+    return audio_io.find_audio_files(path)
 
-def get_wav_files(path):
-    """Get all WAV files from a directory."""
-    wav_files = glob.glob(os.path.join(path, "**", "*.wav"), recursive=True)
-    wav_files.extend(glob.glob(os.path.join(path, "**", "*.WAV"), recursive=True))
-    return wav_files
+def site_output_dir(full_path, output, overwrite):
+    """Get the folder the anonymised files of a site are written to."""
+    if overwrite:
+        return Path(full_path)
+    return Path(output) if output else Path(full_path) / "anonymised_files"
+
+def site_recordings(full_path, output_dir, overwrite):
+    """Get the recordings of a site folder, leaving out anonymised copies written inside it."""
+    files = get_audio_files(full_path)
+    if overwrite:
+        return files
+    output_dir = Path(output_dir).resolve()
+    return [file for file in files if not Path(file).resolve().is_relative_to(output_dir)]
 
 def main():
     parser = argparse.ArgumentParser(description="Detect and anonymize human voices in audio files using BirdNET")
@@ -286,6 +252,16 @@ def main():
                        help="Overwrite original files instead of creating copies")
     parser.add_argument("--minconf", type=float, default=0.5,
                        help="Minimum confidence threshold for detections")
+    parser.add_argument("--format", choices=["same", "wav", "flac"], default="same",
+                       help="Audio format of the anonymised files (default: same as the input)")
+    parser.add_argument("--stage_dir", type=str, default=None,
+                       help="Local scratch folder to copy each site to before analysis, the next site is copied in the background")
+    parser.add_argument("--stage_max_gb", type=float, default=500,
+                       help="Maximum size of the local staging cache in GB (default: 500)")
+    parser.add_argument("--dedup", action="store_true",
+                       help="Analyse recordings with identical content only once and write duplicates.csv to each site")
+    parser.add_argument("--fresh", action="store_true",
+                       help="Ignore the journals of earlier runs and process every site from the start")
     parser.add_argument("--verbose", "-v", action="store_true",
                        help="Enable verbose console output (default: minimal console output)")
     
@@ -316,8 +292,12 @@ def main():
         logger.error(f"Error reading metadata file: {e}")
         return 1
     
-    # Create species list file
-    slist = create_slist()
+    # Optionally copy recordings to local scratch, prefetching the next site while the current one is processed
+    cache = None
+    if args.stage_dir:
+        cache = staging.StagingCache(args.stage_dir, int(args.stage_max_gb * 1e9))
+    home_dir = os.path.expanduser("~")
+    site_paths = [os.path.join(home_dir, path) for path in metadata_df['path_to_recordings']]
     
     try:
         total_processed = 0
@@ -342,111 +322,145 @@ def main():
             if not args.verbose:
                 print(f"[{site_idx}/{len(metadata_df)}] Processing site: {site_name}")
             
+            # The recordings of the site, as paths in the site folder. Anonymised copies inside it are left out.
+            output_dir = site_output_dir(full_path, args.output, args.overwrite)
+            site_files = site_recordings(full_path, output_dir, args.overwrite)
+            
+            # Read from the local copy if staging is enabled, only the recordings are staged. The current site is
+            # marked active before the next one is queued, so it is never evicted for it.
+            read_path = full_path
+            if cache is not None:
+                read_path = cache.get(full_path, site_files)
+                if site_idx < len(site_paths):
+                    next_path = site_paths[site_idx]
+                    next_output_dir = site_output_dir(next_path, args.output, args.overwrite)
+                    cache.prefetch(next_path, site_recordings(next_path, next_output_dir, args.overwrite))
+                if read_path != os.path.abspath(full_path):
+                    logger.info(f"Reading staged copy: {read_path}")
+                else:
+                    read_path = full_path
+            
             # Set up output directory
-            if args.overwrite:
-                output_dir = Path(full_path)
-            else:
-                output_dir = Path(args.output) if args.output else Path(full_path) / "anonymised_files"
+            if not args.overwrite:
                 output_dir.mkdir(parents=True, exist_ok=True)
             
-            # Create temp directory for BirdNET results
-            temp_dir = output_dir / "temp_birdnet_results"
-            temp_dir.mkdir(parents=True, exist_ok=True)
-            
             logger.info(f"Processing site: {site_name}")
             
-            # Step 1: Run BirdNET
-            if not run_birdnet_batch(full_path, temp_dir, args.threads, slist, args.minconf, args.verbose):
-                logger.error(f"Failed BirdNET analysis for: {site_name}")
+            if not site_files:
+                logger.warning(f"No WAV or FLAC files found in: {full_path}")
                 if not args.verbose:
-                    print(f"  FAILED: BirdNET analysis failed")
+                    print(f"  No WAV or FLAC files found")
                 continue
             
-            # Step 2: Find and move the combined results file
-            birdnet_combined = temp_dir / "BirdNET_CombinedTable.csv"
-            if not birdnet_combined.exists():
-                logger.error(f"BirdNET combined results file not found: {birdnet_combined}")
-                # List what files are actually in the temp directory
-                temp_files = list(temp_dir.glob("*"))
-                logger.error(f"Files in temp directory: {temp_files}")
-                if not args.verbose:
-                    print(f"  FAILED: Results file not found")
-                continue
+            # Optionally find recordings with identical content, they get the detections of their canonical copy
+            groups = []
+            if args.dedup:
+                groups = [[os.path.join(full_path, os.path.relpath(f, read_path)) for f in group]
+                          for group in dedup.find_duplicates([os.path.join(read_path, os.path.relpath(f, full_path))
+                                                              for f in site_files])]
             
-            # Move and rename the results file to the site directory
+            # Reuse the detections of an earlier run if the journal says detection finished with the same settings,
+            # and only analyse the recordings that were added or changed since
             human_voices_file = Path(full_path) / "human_voices.csv"
-            shutil.move(str(birdnet_combined), str(human_voices_file))
-            logger.info(f"Moved results file to: {human_voices_file}")
+            journal_file = Path(full_path) / JOURNAL_NAME
+            journal = load_journal(journal_file)
+            if (args.fresh or journal['minconf'] != args.minconf or journal['dedup'] != args.dedup
+                    or not human_voices_file.exists()):
+                journal = {'minconf': None, 'dedup': None, 'stage': None, 'analysed': {}, 'duplicates': {}, 'files': {}}
             
-            # Verify the file exists and show its size
-            if human_voices_file.exists():
-                file_size = human_voices_file.stat().st_size
-                logger.info(f"Results file exists and is {file_size} bytes")
-            else:
-                logger.error(f"Results file does not exist after move: {human_voices_file}")
-                if not args.verbose:
-                    print(f"  FAILED: Could not create results file")
-                continue
+            to_detect = site_files if journal['stage'] is None else unanalysed_files(journal, site_files)
             
-            # Step 3: Parse results and process files
-            file_detections = parse_results(str(human_voices_file))
-            wav_files = get_wav_files(full_path)
-            
-            if not wav_files:
-                logger.warning(f"No WAV files found in: {full_path}")
+            # Duplicates found now only apply to the recordings analysed now. Earlier duplicates come from the
+            # journal, because zeroing a canonical copy with --overwrite changes its content.
+            detect_set = set(to_detect)
+            duplicates = {d: c for d, c in journal['duplicates'].items() if d not in detect_set}
+            new_duplicates = {d: c for d, c in dedup.duplicate_map(groups).items() if d in detect_set}
+            duplicates.update(new_duplicates)
+            if args.dedup and journal['stage'] is None:
+                dedup.write_report(groups, os.path.join(full_path, "duplicates.csv"))
+            if new_duplicates:
+                logger.info(f"Found {len(new_duplicates)} duplicate recordings, only their canonical copies are analysed")
+            if journal['stage'] is not None:
+                logger.info(f"Journal found, reusing detections in {human_voices_file}, "
+                            f"{len(to_detect)} new or changed files will be analysed")
                 if not args.verbose:
-                    print(f"  No WAV files found")
-                continue
+                    print(f"  Resuming from journal, reusing existing detections")
+                    if to_detect:
+                        print(f"  {len(to_detect)} new or changed files will be analysed")
             
+            if not to_detect:
+                file_detections = parse_results(str(human_voices_file))
+            else:
+                # Step 1: Run BirdNET
+                analyse = [os.path.join(read_path, os.path.relpath(f, full_path)) for f in to_detect if f not in duplicates]
+                detections_df = run_birdnet_batch(read_path, full_path, args.threads, args.minconf, args.verbose, analyse)
+                if detections_df is None:
+                    logger.error(f"Failed BirdNET analysis for: {site_name}")
+                    if not args.verbose:
+                        print(f"  FAILED: BirdNET analysis failed")
+                    continue
+                
+                # Step 2: Save the results file to the site directory, replacing older detections of changed files
+                if journal['stage'] is not None:
+                    previous = pd.read_csv(human_voices_file)
+                    previous = previous[~previous['File'].isin(to_detect)]
+                    detections_df = pd.concat([previous, detections_df], ignore_index=True)
+                detections_df.to_csv(human_voices_file, index=False)
+                logger.info(f"Saved results file to: {human_voices_file}")
+                
+                # Record the analysed recordings in the journal, starting a new one for a fresh site
+                if journal['stage'] is None:
+                    start_journal(journal_file, args.minconf, args.dedup, file_stats(to_detect), new_duplicates)
+                else:
+                    journal_detected(journal_file, file_stats(to_detect), new_duplicates)
+                journal['stage'] = "detected"
+                file_detections = get_detections(detections_df)
+            file_detections = pipeline.expand_detections(file_detections, duplicates)
+            
+            # Step 3: Process files
             if not args.verbose:
                 total_detections = sum(len(segments) for segments in file_detections.values())
                 files_with_detections = len(file_detections)
-                files_without_detections = len(wav_files) - files_with_detections
+                files_without_detections = len(site_files) - files_with_detections
                 print(f"  Found {total_detections} human voice segments in {files_with_detections} files")
                 if files_without_detections > 0:
                     print(f"  {files_without_detections} files have no human voice detections")
-                print(f"  Processing {files_with_detections} WAV files...")
+                print(f"  Processing {files_with_detections} audio files...")
+                if args.format != "same":
+                    print(f"  Converting the other files to {args.format}")
             
-            # Process each WAV file
+            # Skip files the journal shows were already rewritten
+            done = [wav_path_str for wav_path_str, entry in journal['files'].items() if file_done(entry)]
+            site_skipped = len(done)
             site_processed = 0
             site_failed = 0
             
-            # Instead of iterating through all wav_files, iterate through files that have detections
-            for wav_path_str in file_detections.keys():
-                wav_path = Path(wav_path_str)  # Convert string path to Path object
-                
-                # Debug: Show what we're processing
-                logger.info(f"=== Processing WAV file: {wav_path.name} ===")
-                logger.info(f"Full path: {wav_path}")
-                
-                # Determine output path
-                if args.overwrite:
-                    output_file = wav_path
-                else:
-                    rel_path = wav_path.relative_to(full_path)
-                    output_file = output_dir / rel_path
-                    output_file.parent.mkdir(parents=True, exist_ok=True)
-                
-                # Get detections for this file (we know it exists since we're iterating through the keys)
-                segments = file_detections[wav_path_str]
-                
-                logger.info(f"Found {len(segments)} segments for {wav_path.name}")
-                if segments:
-                    logger.info(f"First few segments: {segments[:3]}...")  # Show first 3 segments
-                
-                # Zero out human voice segments
-                if zero_segments(wav_path, output_file, segments, args.verbose):
+            # Zero out human voice segments, writing the files back in one sequential pass. When converting,
+            # files without detections are rewritten in the new format too.
+            output = None if args.overwrite else output_dir
+            fmt = None if args.format == "same" else args.format
+            for result in pipeline.anonymise_site(full_path, file_detections, output, fmt, read_path, skip=done):
+                name = Path(result['file']).name
+                if result['error'] is None:
+                    logger.info(f"Zeroed {result['frames_zeroed']} frames in {result['segments']} segments: {result['output']}")
+                    print_progress(f"    Processed {name} - zeroed {result['segments']} segments", args.verbose)
+                    journal_file_done(journal_file, result['file'], result['output'])
                     total_processed += 1
                     site_processed += 1
                 else:
+                    logger.error(f"Error processing {result['file']}: {result['error']}")
+                    if not args.verbose:
+                        print(f"    ERROR processing {name}")
                     total_failed += 1
                     site_failed += 1
                         
             if not args.verbose:
                 print(f"  Completed: {site_processed} processed, {site_failed} failed")
+                if site_skipped > 0:
+                    print(f"  {site_skipped} files were already anonymised in an earlier run")
             
-            # Clean up temp directory
-            shutil.rmtree(temp_dir)
+            if site_failed == 0 and journal['stage'] != "complete":
+                journal_stage(journal_file, "complete")
             
             logger.info(f"Site {site_name} complete")
         
@@ -473,9 +487,9 @@ def main():
             print(f"ERROR: {e}")
         return 1
     finally:
-        # Clean up species list file
-        if os.path.exists(slist):
-            os.remove(slist)
+        # Remove staged recordings
+        if cache is not None:
+            cache.close()
 
 if __name__ == "__main__":
     exit(main())
@@ -0,0 +1,231 @@
+"""
+Audio file helpers shared by the TOEK scripts.
+
+Supports uncompressed .wav files through the standard library and .flac files through soundfile
+(pip install soundfile). Samples are always returned as int32 arrays of shape (frames, channels), scaled to the
+full int32 range, so blocks can be written to either format without loss. FLAC stores at most 24 bits, so 32-bit
+.wav files are written to FLAC as 24-bit.
+"""
+
+import io
+import os
+import struct
+import wave
+from collections import namedtuple
+
+import numpy as np
+
+AUDIO_EXTENSIONS = ('.wav', '.flac')
+
+AudioInfo = namedtuple('AudioInfo', ['samplerate', 'channels', 'sampwidth', 'nframes'])
+
+# soundfile subtype used when writing FLAC files, by sample width in bytes
+FLAC_SUBTYPES = {1: 'PCM_S8', 2: 'PCM_16', 3: 'PCM_24', 4: 'PCM_24'}
+
+
+def _soundfile():
+    """Import soundfile only when a FLAC file is actually used."""
+    try:
+        import soundfile
+    except ImportError:
+        raise ImportError("soundfile is required for FLAC files: pip install soundfile")
+    return soundfile
+
+
+def audio_format(path):
+    """Return 'wav' or 'flac' based on the file extension."""
+    ext = os.path.splitext(str(path))[1].lower()
+    if ext not in AUDIO_EXTENSIONS:
+        raise ValueError(f"Unsupported audio file type: {path}")
+    return ext[1:]
+
+
+def is_audio_file(filename):
+    """Check whether a file name has a supported audio extension (case insensitive)."""
+    return str(filename).lower().endswith(AUDIO_EXTENSIONS)
+
+
+def find_audio_files(path):
+    """Get all supported audio files below a directory, sorted by path."""
+    audio_files = []
+    for root, dirs, files in os.walk(path):
+        for file in files:
+            if is_audio_file(file):
+                audio_files.append(os.path.join(root, file))
+    return sorted(audio_files)
+
+
+def flac_streaminfo(path):
+    """Read sample rate, channels, sample width and length from the FLAC STREAMINFO block without decoding."""
+    with open(path, 'rb') as f:
+        header = f.read(10)
+        # Skip an ID3v2 tag if one was written in front of the stream
+        if header[:3] == b'ID3':
+            size = 0
+            for byte in header[6:10]:
+                size = (size << 7) | (byte & 0x7F)
+            f.seek(10 + size)
+        else:
+            f.seek(0)
+        if f.read(4) != b'fLaC':
+            raise ValueError(f"Not a FLAC file: {path}")
+        block_header = f.read(4)
+        if len(block_header) < 4 or block_header[0] & 0x7F != 0:
+            raise ValueError(f"FLAC file has no STREAMINFO block: {path}")
+        streaminfo = f.read(34)
+        if len(streaminfo) < 34:
+            raise ValueError(f"Truncated FLAC STREAMINFO block: {path}")
+    # Bytes 10-17: 20 bits sample rate, 3 bits channels - 1, 5 bits bits per sample - 1, 36 bits total samples
+    packed, = struct.unpack('>Q', streaminfo[10:18])
+    samplerate = packed >> 44
+    channels = ((packed >> 41) & 0x7) + 1
+    bits = ((packed >> 36) & 0x1F) + 1
+    nframes = packed & 0xFFFFFFFFF
+    return AudioInfo(samplerate, channels, (bits + 7) // 8, nframes)
+
+
+def audio_info(path):
+    """Return the AudioInfo of a .wav or .flac file from its header."""
+    if audio_format(path) == 'flac':
+        info = flac_streaminfo(path)
+        if info.nframes == 0:
+            # The encoder did not know the length when writing the header, so count the frames instead
+            info = info._replace(nframes=_soundfile().info(str(path)).frames)
+        return info
+    try:
+        with wave.open(str(path), 'rb') as wav_file:
+            return AudioInfo(wav_file.getframerate(), wav_file.getnchannels(),
+                             wav_file.getsampwidth(), wav_file.getnframes())
+    except (wave.Error, EOFError) as e:
+        raise ValueError(f"Could not open {path} as a .wav file: {e}")
+
+
+def duration(path):
+    """Return the length of an audio file in seconds."""
+    info = audio_info(path)
+    return info.nframes / float(info.samplerate)
+
+
+def _wav_to_int32(frames, sampwidth, channels):
+    """Convert raw .wav frames to a full scale int32 array of shape (frames, channels)."""
+    if sampwidth == 1:
+        audio = (np.frombuffer(frames, dtype=np.uint8).astype(np.int32) - 128) << 24
+    elif sampwidth == 2:
+        audio = np.frombuffer(frames, dtype='<i2').astype(np.int32) << 16
+    elif sampwidth == 3:
+        raw = np.frombuffer(frames, dtype=np.uint8).reshape(-1, 3).astype(np.int32)
+        audio = (raw[:, 0] << 8) | (raw[:, 1] << 16) | (raw[:, 2] << 24)
+    elif sampwidth == 4:
+        audio = np.frombuffer(frames, dtype='<i4').astype(np.int32)
+    else:
+        raise ValueError(f"Unsupported sample width: {sampwidth}")
+    return audio.reshape(-1, channels)
+
+
+def _int32_to_wav(audio, sampwidth):
+    """Convert a full scale int32 array back to raw .wav frames."""
+    audio = np.asarray(audio, dtype=np.int32).reshape(-1)
+    if sampwidth == 1:
+        return ((audio >> 24) + 128).astype(np.uint8).tobytes()
+    if sampwidth == 2:
+        return (audio >> 16).astype('<i2').tobytes()
+    if sampwidth == 3:
+        shifted = (audio >> 8).astype('<i4').view(np.uint8).reshape(-1, 4)
+        return shifted[:, :3].tobytes()
+    if sampwidth == 4:
+        return audio.astype('<i4').tobytes()
+    raise ValueError(f"Unsupported sample width: {sampwidth}")
+
+
+def read_blocks(path, block_frames, start_frame=0, nframes=None):
+    """
+    Yield the samples of an audio file in blocks of at most block_frames frames.
+
+    Reading starts at start_frame and stops after nframes frames (or the end of the file).
+    """
+    remaining = nframes
+    if audio_format(path) == 'flac':
+        with _soundfile().SoundFile(str(path)) as flac_file:
+            flac_file.seek(min(start_frame, flac_file.frames))
+            while remaining is None or remaining > 0:
+                count = block_frames if remaining is None else min(block_frames, remaining)
+                block = flac_file.read(count, dtype='int32', always_2d=True)
+                if len(block) == 0:
+                    break
+                if remaining is not None:
+                    remaining -= len(block)
+                yield block
+        return
+    try:
+        wav_file = wave.open(str(path), 'rb')
+    except (wave.Error, EOFError) as e:
+        raise ValueError(f"Could not open {path} as a .wav file: {e}")
+    with wav_file:
+        sampwidth = wav_file.getsampwidth()
+        channels = wav_file.getnchannels()
+        wav_file.setpos(min(start_frame, wav_file.getnframes()))
+        while remaining is None or remaining > 0:
+            count = block_frames if remaining is None else min(block_frames, remaining)
+            frames = wav_file.readframes(count)
+            if not frames:
+                break
+            block = _wav_to_int32(frames, sampwidth, channels)
+            if remaining is not None:
+                remaining -= len(block)
+            yield block
+
+
+def read_region(path, start_seconds, duration_seconds):
+    """Read a region of an audio file. Returns the file's AudioInfo and the samples of the region."""
+    info = audio_info(path)
+    start_frame = int(max(0, start_seconds) * info.samplerate)
+    nframes = int(duration_seconds * info.samplerate)
+    blocks = list(read_blocks(path, nframes or 1, start_frame, nframes))
+    audio = np.concatenate(blocks) if blocks else np.zeros((0, info.channels), dtype=np.int32)
+    return info, audio
+
+
+def wav_bytes(audio, samplerate, sampwidth):
+    """Encode an int32 block as an in-memory .wav file."""
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wav_file:
+        wav_file.setnchannels(audio.shape[1])
+        wav_file.setsampwidth(sampwidth)
+        wav_file.setframerate(samplerate)
+        wav_file.writeframes(_int32_to_wav(audio, sampwidth))
+    return buffer.getvalue()
+
+
+class AudioWriter:
+    """
+    Write int32 blocks from read_blocks to a .wav or .flac file.
+
+    The format is taken from the file extension unless fmt ('wav' or 'flac') is given.
+    """
+
+    def __init__(self, path, samplerate, channels, sampwidth, fmt=None):
+        self.fmt = fmt or audio_format(path)
+        self.sampwidth = sampwidth
+        if self.fmt == 'flac':
+            self._file = _soundfile().SoundFile(str(path), 'w', samplerate=samplerate, channels=channels,
+                                                format='FLAC', subtype=FLAC_SUBTYPES[sampwidth])
+        else:
+            self._file = wave.open(str(path), 'wb')
+            self._file.setnchannels(channels)
+            self._file.setsampwidth(sampwidth)
+            self._file.setframerate(samplerate)
+
+    def write(self, block):
+        if self.fmt == 'flac':
+            self._file.write(np.asarray(block, dtype=np.int32))
+        else:
+            self._file.writeframes(_int32_to_wav(block, self.sampwidth))
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
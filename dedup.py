@@ -0,0 +1,66 @@
+"""
+Find duplicate recordings by content.
+
+Files are compared in stages so most files are only partly read: first by size, then by a hash of the header and
+a few sampled blocks, and only files that still collide are hashed in full. In every group of duplicates the
+first path (sorted) is kept as the canonical copy.
+"""
+
+import csv
+import hashlib
+import os
+
+BLOCK_SIZE = 64 * 1024
+
+
+def quick_fingerprint(path, samples=8, block_size=BLOCK_SIZE):
+    """Hash the first block and samples evenly spaced blocks of a file."""
+    size = os.path.getsize(path)
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        digest.update(f.read(block_size))
+        if size > block_size:
+            for i in range(1, samples + 1):
+                f.seek(max(0, (size - block_size) * i // samples))
+                digest.update(f.read(block_size))
+    return digest.hexdigest()
+
+
+def full_hash(path, block_size=1024 * 1024):
+    """Hash the whole file."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _group_by(paths, key):
+    groups = {}
+    for path in paths:
+        groups.setdefault(key(path), []).append(path)
+    return [group for group in groups.values() if len(group) > 1]
+
+
+def find_duplicates(files):
+    """Return the groups of files with identical content, each sorted with the canonical copy first."""
+    duplicates = []
+    for same_size in _group_by(files, os.path.getsize):
+        for same_fingerprint in _group_by(same_size, quick_fingerprint):
+            duplicates.extend(sorted(group) for group in _group_by(same_fingerprint, full_hash))
+    return sorted(duplicates)
+
+
+def duplicate_map(groups):
+    """Map every duplicate path to the canonical path of its group."""
+    return {duplicate: group[0] for group in groups for duplicate in group[1:]}
+
+
+def write_report(groups, report_file):
+    """Write the duplicate groups to a CSV file for the metadata owner."""
+    with open(report_file, "w", newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['group', 'canonical', 'duplicate', 'size'])
+        for i, group in enumerate(groups, start=1):
+            for duplicate in group[1:]:
+                writer.writerow([i, group[0], duplicate, os.path.getsize(duplicate)])
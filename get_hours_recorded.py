@@ -1,25 +1,12 @@
 # import libraries
 import pandas as pd
-import wave
-import os
 import argparse
+import pipeline
 
-# Return the total length of all .wav files in a folder in minutes.
+# Return the total length of all .wav and .flac files in a folder in minutes. Only the file headers are read,
+# files whose header cannot be read are reported and left out.
 def total_wav_length(directory):
-    total_length = 0
-    for root, dirs, files in os.walk(directory):
-        for file in files:
-            if file.endswith('.wav'):
-                try:
-                    with wave.open(os.path.join(root, file), 'rb') as wav_file:
-                        frames = wav_file.getnframes()
-                        rate = wav_file.getframerate()
-                        duration = frames / float(rate)
-                        total_length += duration
-                except wave.Error:
-                    print(f"Could not open {os.path.join(root, file)} as a .wav file")
-    total_length = total_length / 60
-    return total_length
+    return pipeline.scan_site(directory)['duration'].sum() / 60
 
 # Main function
 def main():
@@ -45,7 +32,6 @@ def main():
         # Get path from the path_to_recordings column in the current row
         path = row['path_to_recordings']
         
-        row['minutes_recorded'] = total_wav_length(path)
         # Save the DataFrame to a CSV file
         metaDataList.at[index, 'minutes_recorded'] = total_wav_length(path)
         metaDataList.to_csv(metaData, index=False)
@@ -0,0 +1,590 @@
+"""
+Library API for the TOEK BirdNET pipeline.
+
+The command line scripts (run_birdnet.py, anonymise.py, createValidationData.py) are thin wrappers around these
+functions. They can also be chained directly, e.g. in a notebook, without writing intermediate CSV files:
+
+    import pipeline
+    files = pipeline.scan_site(path)
+    files = files[pipeline.select_recordings(files, time_window=pipeline.parse_time_window("sunrise-30,sunrise+180"),
+                                             lat=48.4, lon=11.7, timezone="Europe/Berlin")]
+    results = pipeline.analyze_site(path, lat=48.4, lon=11.7, week=18, site="A", files=list(files['file']))
+    clips = pipeline.cut_clips(results, "validation", reference=True)
+
+pandas is only imported when a function that returns a DataFrame is called.
+"""
+
+import datetime
+import logging
+import math
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+import audio_io
+
+logger = logging.getLogger(__name__)
+
+SCAN_COLUMNS = ['file', 'samplerate', 'channels', 'duration', 'date', 'time']
+CLIP_COLUMNS = ['site', 'INDIR', 'FOLDER', 'IN FILE', 'OFFSET', 'DURATION', 'MANUAL ID', 'confidence', 'scientific_name']
+
+
+def _pandas():
+    import pandas as pd
+    return pd
+
+
+def extract_date(filename):
+    """Get the date (YYYYMMDD) from a recording's file name."""
+    m = re.search(r'(\d{8})', filename)
+    return m.group(1) if m else None
+
+
+def extract_time(filename):
+    """Get the time (HHMMSS) from a recording's file name."""
+    match = re.search(r'\d{8}.*?(\d{6})(?=\D|$)', filename)
+    return match.group(1) if match else None
+
+
+def scan_site(path):
+    """
+    List the recordings of a site folder from their headers only.
+
+    Returns a DataFrame with one row per .wav or .flac file and the columns file, samplerate, channels,
+    duration (seconds), date and time. Files whose header cannot be read are logged and left out.
+    """
+    rows = []
+    for file in audio_io.find_audio_files(path):
+        try:
+            info = audio_io.audio_info(file)
+        except (ValueError, RuntimeError, ImportError) as e:
+            logger.warning(f"Could not read the header of {file} ({e})")
+            continue
+        name = os.path.basename(file)
+        rows.append((file, info.samplerate, info.channels, info.nframes / float(info.samplerate),
+                     extract_date(name), extract_time(name)))
+    return _pandas().DataFrame(rows, columns=SCAN_COLUMNS)
+
+
+def parse_date(text):
+    """Parse a date given as YYYY-MM-DD, YYYYMMDD or DD/MM/YYYY."""
+    for fmt in ("%Y-%m-%d", "%Y%m%d", "%d/%m/%Y"):
+        try:
+            return datetime.datetime.strptime(text, fmt).date()
+        except ValueError:
+            pass
+    raise ValueError(f"Invalid date {text!r}, use YYYY-MM-DD")
+
+
+def parse_date_range(text):
+    """Parse 'START,END' into a pair of dates. Both dates are included."""
+    parts = text.split(',')
+    if len(parts) != 2:
+        raise ValueError(f"Invalid date range {text!r}, use START,END")
+    start, end = parse_date(parts[0].strip()), parse_date(parts[1].strip())
+    if end < start:
+        raise ValueError(f"Date range {text!r} ends before it starts")
+    return start, end
+
+
+def parse_time_window(text):
+    """
+    Parse 'START,END' into a time window. Each end is a clock time (HH:MM) or sunrise/sunset with an optional
+    offset in minutes, e.g. 'sunrise-30,sunrise+180'. Returns a pair of (anchor, minutes) with anchor None for
+    clock times (minutes after midnight) and 'sunrise' or 'sunset' for sun relative times (offset in minutes).
+    """
+    parts = text.split(',')
+    if len(parts) != 2:
+        raise ValueError(f"Invalid time window {text!r}, use START,END")
+    window = []
+    for part in parts:
+        part = part.strip().lower()
+        match = re.fullmatch(r'(sunrise|sunset)(?:([+-])(\d+))?', part)
+        if match:
+            anchor, sign, offset = match.groups()
+            window.append((anchor, int(offset or 0) * (-1 if sign == '-' else 1)))
+            continue
+        match = re.fullmatch(r'(\d{1,2}):(\d{2})', part)
+        if not match or int(match.group(2)) > 59 or int(match.group(1)) * 60 + int(match.group(2)) > 24 * 60:
+            raise ValueError(f"Invalid time {part!r}, use HH:MM or sunrise/sunset with an offset in minutes")
+        window.append((None, int(match.group(1)) * 60 + int(match.group(2))))
+    return tuple(window)
+
+
+def sun_times(date, lat, lon):
+    """
+    Return sunrise and sunset on a date as minutes after midnight UTC, using the NOAA solar equations (accurate to
+    a few minutes). Returns (None, None) if the sun does not rise or set on that day.
+    """
+    gamma = 2 * math.pi / 365 * (date.timetuple().tm_yday - 1)
+    eqtime = 229.18 * (0.000075 + 0.001868 * math.cos(gamma) - 0.032077 * math.sin(gamma)
+                       - 0.014615 * math.cos(2 * gamma) - 0.040849 * math.sin(2 * gamma))
+    decl = (0.006918 - 0.399912 * math.cos(gamma) + 0.070257 * math.sin(gamma) - 0.006758 * math.cos(2 * gamma)
+            + 0.000907 * math.sin(2 * gamma) - 0.002697 * math.cos(3 * gamma) + 0.00148 * math.sin(3 * gamma))
+    lat = math.radians(lat)
+    cos_ha = math.cos(math.radians(90.833)) / (math.cos(lat) * math.cos(decl)) - math.tan(lat) * math.tan(decl)
+    if abs(cos_ha) > 1:
+        return None, None
+    ha = math.degrees(math.acos(cos_ha))
+    return 720 - 4 * (lon + ha) - eqtime, 720 - 4 * (lon - ha) - eqtime
+
+
+def parse_timezone(name):
+    """Check that a time zone name (e.g. Europe/Berlin) is known and return it."""
+    if name.upper() == 'UTC':
+        return name
+    from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+    try:
+        ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        raise ValueError(f"Unknown time zone {name!r}, use a name like Europe/Berlin")
+    return name
+
+
+def _utc_offset(date, timezone):
+    """Minutes to add to UTC to get the local time of a time zone on a date."""
+    if timezone is None or timezone.upper() == 'UTC':
+        return 0
+    from zoneinfo import ZoneInfo
+    noon = datetime.datetime.combine(date, datetime.time(12), tzinfo=ZoneInfo(timezone))
+    return noon.utcoffset().total_seconds() / 60
+
+
+def window_minutes(time_window, date, lat=None, lon=None, timezone='UTC'):
+    """
+    Return a time window from parse_time_window as (start, end) in minutes after local midnight on a date.
+    end is larger than start, windows that pass midnight end after 1440. Returns None if a sun relative end
+    does not exist on that day.
+    """
+    bounds = []
+    for anchor, minutes in time_window:
+        if anchor is not None:
+            if lat is None or lon is None:
+                raise ValueError("Sunrise and sunset windows need the latitude and longitude of the site")
+            sunrise, sunset = sun_times(date, float(lat), float(lon))
+            if sunrise is None:
+                return None
+            minutes += (sunrise if anchor == 'sunrise' else sunset) + _utc_offset(date, timezone)
+        bounds.append(minutes % 1440)
+    start, end = bounds
+    return start, end if end > start else end + 1440
+
+
+def select_recordings(scan, date_range=None, time_window=None, lat=None, lon=None, timezone='UTC'):
+    """
+    Select the recordings of a scan_site table by the date and time in their file names.
+
+    date_range is a pair of dates from parse_date_range, time_window a window from parse_time_window. A recording
+    is selected if it was made in the date range and overlaps the time window; sunrise and sunset are computed for
+    the date of each recording at lat/lon, and timezone is the zone of the times in the file names. Recordings
+    without a date or time in their name are not selected. Returns a boolean Series aligned with scan.
+    """
+    pd = _pandas()
+    selected = pd.Series(True, index=scan.index)
+    windows = {}
+    for index, date, time, length in zip(scan.index, scan['date'], scan['time'], scan['duration']):
+        try:
+            day = datetime.datetime.strptime(date, "%Y%m%d").date()
+        except (TypeError, ValueError):
+            selected[index] = False
+            continue
+        if date_range is not None and not date_range[0] <= day <= date_range[1]:
+            selected[index] = False
+            continue
+        if time_window is None:
+            continue
+        if time is None or int(time[:2]) > 23:
+            selected[index] = False
+            continue
+        if day not in windows:
+            windows[day] = window_minutes(time_window, day, lat, lon, timezone)
+        window = windows[day]
+        start = int(time[:2]) * 60 + int(time[2:4]) + int(time[4:]) / 60
+        end = start + length / 60
+        # Recordings and windows can both pass midnight, so also compare with the window of the day before and after
+        selected[index] = window is not None and any(start + shift < window[1] and end + shift > window[0]
+                                                     for shift in (-1440, 0, 1440))
+    return selected
+
+
+def window_levels(audio_path, window_seconds=3, windows_per_block=100):
+    """
+    Return the RMS level (dBFS) of every window in a .wav or .flac file.
+
+    The file is read in blocks of whole windows so that long recordings are never loaded into memory at once.
+    """
+    levels = []
+    info = audio_io.audio_info(audio_path)
+    window_frames = max(1, int(window_seconds * info.samplerate))
+    for block in audio_io.read_blocks(audio_path, window_frames * windows_per_block):
+        # Mean power over all channels of each frame, relative to full scale
+        power = ((block / 2.0 ** 31) ** 2).mean(axis=1)
+        starts = np.arange(0, len(power), window_frames)
+        counts = np.diff(np.append(starts, len(power)))
+        mean_power = np.add.reduceat(power, starts) / counts
+        levels.append(10 * np.log10(np.maximum(mean_power, 1e-20)))
+    return np.concatenate(levels) if levels else np.array([])
+
+
+def split_silent_files(directory, silence_db, window_seconds=3, files=None):
+    """
+    Split the audio files in a folder (or only files, if given) into files that should be analysed and files
+    whose loudest window is below the silence floor (dBFS). Returns both lists and the total length of the silent
+    files in minutes.
+    """
+    active_files = []
+    silent_files = []
+    silent_length = 0
+    for audio_path in (audio_io.find_audio_files(directory) if files is None else files):
+        try:
+            levels = window_levels(audio_path, window_seconds)
+            duration = audio_io.duration(audio_path)
+        except (ValueError, RuntimeError, ImportError) as e:
+            # Files that cannot be checked are always analysed
+            logger.warning(f"Could not check {audio_path} for silence ({e}), it will be analysed")
+            active_files.append(audio_path)
+            continue
+        if len(levels) == 0 or levels.max() < silence_db:
+            silent_files.append(audio_path)
+            silent_length += duration
+        else:
+            active_files.append(audio_path)
+    return active_files, silent_files, silent_length / 60
+
+
+def link_files(files, directory, link_dir):
+    """Link files into link_dir, keeping their folder structure relative to directory."""
+    for file in files:
+        link = os.path.join(link_dir, os.path.relpath(file, directory))
+        os.makedirs(os.path.dirname(link), exist_ok=True)
+        os.symlink(os.path.abspath(file), link)
+
+
+def restore_paths(df, analysis_path, directory):
+    """
+    Point the INDIR and FOLDER columns of a Kaleidoscope results table at the original recordings in directory
+    instead of the links or local copies in analysis_path that BirdNET was run on.
+    """
+    analysis_path = os.path.abspath(analysis_path)
+    directory = os.path.abspath(directory)
+    indirs, folders = [], []
+    for indir, folder in zip(df['INDIR'], df['FOLDER']):
+        folder = os.path.join(indir, folder)
+        if os.path.commonpath([os.path.abspath(folder), analysis_path]) == analysis_path:
+            folder = os.path.join(directory, os.path.relpath(folder, analysis_path))
+        folder = os.path.normpath(folder)
+        indirs.append(os.path.dirname(folder))
+        folders.append(os.path.basename(folder))
+    df['INDIR'] = indirs
+    df['FOLDER'] = folders
+    return df
+
+
+def _run_birdnet(input_path, output_dir, options):
+    """Run the BirdNET analyzer on a file or folder and return its console output."""
+    command = ["python", "-m", "birdnet_analyzer.analyze", str(input_path), "-o", str(output_dir)]
+    command += [str(option) for option in options]
+    logger.info(f"Call: {' '.join(command)}")
+    try:
+        output = subprocess.run(command, capture_output=True, text=True, check=True).stdout
+    except subprocess.CalledProcessError as e:
+        logger.error(f"BirdNET failed: {e}")
+        logger.error(f"stderr: {e.stderr}")
+        raise
+    logger.info(f"Output: {output}")
+    return output
+
+
+def _find_file(directory, name):
+    for root, dirs, files in os.walk(directory):
+        if name in files:
+            return os.path.join(root, name)
+    raise FileNotFoundError(f"{name} not found in {directory} or its subfolders")
+
+
+def _birdnet_input(path, files, work):
+    """Return the folder BirdNET should be run on, linking only the given files if there are any."""
+    if files is None:
+        return path
+    link_dir = os.path.join(work, "input")
+    link_files(files, path, link_dir)
+    return link_dir
+
+
+def analyze_site(path, lat, lon, week, site=None, files=None, threads=1, min_conf=0.1, extra_args=(),
+                 source_path=None, work_dir=None):
+    """
+    Run BirdNET on a site folder and return the detections as a DataFrame.
+
+    The DataFrame is in Kaleidoscope format with added site, date and timestamp columns. If files is given only
+    those files (inside path) are analysed. If path is a copy of the recordings, e.g. a staged local copy,
+    source_path is the original folder and the results point there. BirdNET's own output is written to a
+    temporary folder inside work_dir and removed afterwards. extra_args are passed on to BirdNET, except --rtype
+    because the results are always read in Kaleidoscope format.
+    """
+    pd = _pandas()
+    if any(str(arg) == "--rtype" or str(arg).startswith("--rtype=") for arg in extra_args):
+        raise ValueError("--rtype cannot be changed, the results are always read in Kaleidoscope format")
+    if files is not None and len(files) == 0:
+        return pd.DataFrame()
+    work = tempfile.mkdtemp(prefix="birdnet_", dir=work_dir)
+    try:
+        input_path = _birdnet_input(path, files, work)
+        output_dir = os.path.join(work, "output")
+        os.makedirs(output_dir)
+        _run_birdnet(input_path, output_dir, [
+            "--lat", lat, "--lon", lon, "--week", week, "--rtype", "kaleidoscope",
+            "--threads", threads, "--min_conf", min_conf, "--combine_results"] + list(extra_args))
+        df = pd.read_csv(_find_file(output_dir, "BirdNET_Kaleidoscope.csv"))
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+    original = source_path or path
+    if len(df) > 0 and os.path.abspath(input_path) != os.path.abspath(original):
+        df = restore_paths(df, input_path, original)
+    df['site'] = site
+    df['date'] = df['IN FILE'].apply(extract_date)
+    df['timestamp'] = df['IN FILE'].apply(extract_time)
+    return df
+
+
+def detect_voices(path, threads=1, min_conf=0.5, files=None, source_path=None, work_dir=None):
+    """
+    Run BirdNET with a human vocal species list on a site folder.
+
+    Returns BirdNET's combined table as a DataFrame. If files is given only those files (inside path) are
+    analysed. If path is a copy of the recordings, source_path is the original folder and the File column points
+    there.
+    """
+    pd = _pandas()
+    if files is not None and len(files) == 0:
+        return pd.DataFrame(columns=['Start (s)', 'End (s)', 'File'])
+    work = tempfile.mkdtemp(prefix="birdnet_", dir=work_dir)
+    try:
+        input_path = _birdnet_input(path, files, work)
+        slist = os.path.join(work, "species_list.txt")
+        with open(slist, "w") as file:
+            file.write("Human vocal_Human vocal")
+        output_dir = os.path.join(work, "output")
+        os.makedirs(output_dir)
+        _run_birdnet(input_path, output_dir, [
+            "--threads", threads, "--combine_results", "--slist", slist, "--min_conf", min_conf, "--rtype", "csv"])
+        df = pd.read_csv(_find_file(output_dir, "BirdNET_CombinedTable.csv"))
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+    if len(df) > 0 and os.path.abspath(input_path) != os.path.abspath(source_path or path):
+        df['File'] = [os.path.join(source_path or path, os.path.relpath(f, input_path)) for f in df['File']]
+    return df
+
+
+def voice_segments(df):
+    """Group the detections of a BirdNET combined table by file. Returns {file: [(start, end), ...]}."""
+    file_detections = {}
+    for filename, start_time, end_time in zip(df['File'], df['Start (s)'], df['End (s)']):
+        file_detections.setdefault(filename, []).append((float(start_time), float(end_time)))
+    return file_detections
+
+
+def expand_detections(detections, duplicates):
+    """Give every duplicate recording the detections of its canonical copy. duplicates is {duplicate: canonical}."""
+    detections = dict(detections)
+    for duplicate, canonical in duplicates.items():
+        if canonical in detections:
+            detections[duplicate] = detections[canonical]
+    return detections
+
+
+def attach_duplicates(df, duplicates, site_of=None):
+    """
+    Copy the Kaleidoscope results of every canonical recording to its duplicates.
+
+    duplicates is {duplicate: canonical}. The copied rows point at the duplicate's path, get a duplicate_of column
+    with the canonical path, and take their site from site_of ({path: site}) if given.
+    """
+    pd = _pandas()
+    if len(df) == 0 or not duplicates:
+        return df
+    paths = [os.path.normpath(os.path.join(indir, folder, name))
+             for indir, folder, name in zip(df['INDIR'], df['FOLDER'], df['IN FILE'])]
+    rows_by_path = df.groupby(pd.Series(paths, index=df.index)).groups
+    copies = []
+    for duplicate, canonical in duplicates.items():
+        if canonical not in rows_by_path:
+            continue
+        copy = df.loc[rows_by_path[canonical]].copy()
+        folder = os.path.dirname(duplicate)
+        copy['INDIR'] = os.path.dirname(folder)
+        copy['FOLDER'] = os.path.basename(folder)
+        copy['IN FILE'] = os.path.basename(duplicate)
+        copy['duplicate_of'] = canonical
+        if site_of is not None:
+            copy['site'] = site_of.get(duplicate, copy['site'])
+        if 'date' in copy.columns:
+            copy['date'] = extract_date(os.path.basename(duplicate))
+            copy['timestamp'] = extract_time(os.path.basename(duplicate))
+        copies.append(copy)
+    return pd.concat([df] + copies, ignore_index=True)
+
+
+def zero_file(input_file, output_file, segments, block_seconds=60):
+    """
+    Write a copy of an audio file with the given (start, end) segments in seconds set to silence.
+
+    The file is streamed in blocks, so recordings are never loaded into memory at once. The output format is taken
+    from the extension of output_file, and if input and output are the same file it is replaced once the new
+    version is complete. Returns the number of frames that were zeroed.
+    """
+    info = audio_io.audio_info(input_file)
+    framerate = info.samplerate
+
+    # Convert segments to frame ranges, clamped to the length of the file
+    ranges = []
+    for start_time, end_time in segments:
+        start_frame = max(0, int(start_time * framerate))
+        end_frame = min(info.nframes, int(end_time * framerate))
+        if start_frame < end_frame:
+            ranges.append((start_frame, end_frame))
+
+    # Write to a temporary file next to the output so an overwrite only replaces the original when complete
+    output_file = Path(output_file)
+    temp_output = output_file.with_name(f".{output_file.name}.part")
+    frames_zeroed = 0
+    position = 0
+    try:
+        with audio_io.AudioWriter(temp_output, framerate, info.channels, info.sampwidth,
+                                  fmt=audio_io.audio_format(output_file)) as writer:
+            for block in audio_io.read_blocks(input_file, int(block_seconds * framerate)):
+                block_end = position + len(block)
+                for start_frame, end_frame in ranges:
+                    if start_frame < block_end and end_frame > position:
+                        lo = max(start_frame, position) - position
+                        hi = min(end_frame, block_end) - position
+                        block[lo:hi] = 0
+                        frames_zeroed += hi - lo
+                writer.write(block)
+                position = block_end
+        os.replace(temp_output, output_file)
+    except BaseException:
+        # Do not leave a partial file in the recording folder
+        temp_output.unlink(missing_ok=True)
+        raise
+    return frames_zeroed
+
+
+def anonymise_site(path, detections=None, output_dir=None, fmt=None, read_path=None, threads=1, min_conf=0.5,
+                   duplicates=None, work_dir=None, skip=()):
+    """
+    Zero out human voices in the recordings of a site folder, one file at a time.
+
+    detections is {file: [(start, end), ...]} as returned by voice_segments; if it is None, detect_voices is run
+    first. Files are written to output_dir keeping their folder structure, or overwrite the originals if
+    output_dir is None. fmt ('wav' or 'flac') converts the output, including the files without detections, so the
+    whole site ends up in one format; when overwriting, the original is then removed. Files in skip (e.g. already
+    written by an earlier run) are left out.
+    If read_path is a copy of the recordings (e.g. staged on local disk) audio is read from there. duplicates
+    ({duplicate: canonical}, paths in path) are not analysed, they get the detections of their canonical copy.
+
+    Yields a dict per file with the keys file, output, segments, frames_zeroed and error (None on success), in
+    path order so the output is written in one sequential pass.
+    """
+    read_path = read_path or path
+    duplicates = duplicates or {}
+    if detections is None:
+        files = None
+        if duplicates:
+            files = [os.path.join(read_path, os.path.relpath(file, path)) for file in audio_io.find_audio_files(path)
+                     if file not in duplicates]
+        detections = voice_segments(detect_voices(read_path, threads, min_conf, files=files, source_path=path,
+                                                  work_dir=work_dir))
+    detections = expand_detections(detections, duplicates)
+
+    # When converting, recordings without detections are written too, without any silence. Files already in
+    # output_dir (e.g. anonymised_files inside the site folder) are not recordings of the site.
+    if fmt is not None:
+        known = {os.path.normpath(file) for file in detections}
+        for file in audio_io.find_audio_files(read_path):
+            source = os.path.join(path, os.path.relpath(file, read_path))
+            if output_dir is not None and Path(source).resolve().is_relative_to(Path(output_dir).resolve()):
+                continue
+            if os.path.normpath(source) not in known and audio_io.audio_format(file) != fmt:
+                detections[source] = []
+    skip = {os.path.normpath(file) for file in skip}
+    detections = {file: segments for file, segments in detections.items() if os.path.normpath(file) not in skip}
+
+    for file in sorted(detections):
+        source = Path(file)
+        rel_path = source.relative_to(path)
+        output_file = source if output_dir is None else Path(output_dir) / rel_path
+        if fmt is not None:
+            output_file = output_file.with_suffix(f".{fmt}")
+        result = {'file': file, 'output': str(output_file), 'segments': len(detections[file]),
+                  'frames_zeroed': 0, 'error': None}
+        try:
+            output_file.parent.mkdir(parents=True, exist_ok=True)
+            result['frames_zeroed'] = zero_file(Path(read_path) / rel_path, output_file, detections[file])
+            # When overwriting in a new format the original file is replaced by the converted one
+            if output_dir is None and output_file != source:
+                source.unlink()
+        except Exception as e:
+            result['error'] = f"{type(e).__name__}: {e}"
+        yield result
+
+
+def iter_clips(detections, padding=2):
+    """
+    Yield the padded audio of every detection in a Kaleidoscope results table.
+
+    Yields (row, info, audio) with the detection row, the source file's AudioInfo and the int32 samples.
+    """
+    for _, row in detections.iterrows():
+        start = max(0, row['OFFSET'] - padding)
+        wav_path = os.path.join(row['INDIR'], row['FOLDER'], row['IN FILE'])
+        info, audio = audio_io.read_region(wav_path, start, row['OFFSET'] + 3 + padding - start)
+        yield row, info, audio
+
+
+def _clip_row(row, padding, indir, folder, name, offset):
+    start = max(0, row['OFFSET'] - padding)
+    return {
+        'site': row.get('site', ''),
+        'INDIR': indir,
+        'FOLDER': folder,
+        'IN FILE': name,
+        'OFFSET': offset,
+        'DURATION': row['OFFSET'] + 3 + padding - start,
+        'MANUAL ID': row.get('common_name', ''),
+        'confidence': row.get('confidence', ''),
+        'scientific_name': row.get('scientific_name', ''),
+    }
+
+
+def cut_clips(detections, output_dir=None, padding=2, fmt='wav', reference=False):
+    """
+    Create a validation list from a Kaleidoscope results table and return it as a DataFrame.
+
+    Each detection is padded on both sides and cut into output_dir/wav_files as <row number>.<fmt>. With
+    reference=True nothing is copied and the list points at the padded region of the original file instead.
+    """
+    pd = _pandas()
+    rows = []
+    if reference:
+        for _, row in detections.iterrows():
+            rows.append(_clip_row(row, padding, row['INDIR'], row['FOLDER'], row['IN FILE'],
+                                  max(0, row['OFFSET'] - padding)))
+        return pd.DataFrame(rows, columns=CLIP_COLUMNS)
+
+    wav_output_dir = os.path.join(output_dir, "wav_files")
+    os.makedirs(wav_output_dir, exist_ok=True)
+    for unique_id, (row, info, audio) in enumerate(iter_clips(detections, padding)):
+        new_wav_name = f"{unique_id}.{fmt}"
+        with audio_io.AudioWriter(os.path.join(wav_output_dir, new_wav_name), info.samplerate, info.channels,
+                                  info.sampwidth) as new_wav_file:
+            new_wav_file.write(audio)
+        rows.append(_clip_row(row, padding, ".", "wav_files", new_wav_name, 0))
+    return pd.DataFrame(rows, columns=CLIP_COLUMNS)
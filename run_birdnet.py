@@ -15,123 +15,215 @@
 # 2. Activate the BirdNET venv. source /opt/birdnet-venv/bin/activate
 # 3. Enter the program call:
 # python3 run_birdnet.py --o birdnet_results --meta marlene.csv --threads 18
+# To only analyse the dawn chorus in spring, by the date and time in the file names:
+# python3 run_birdnet.py --o birdnet_results --meta marlene.csv --threads 18 --date-range 2024-03-01,2024-05-31 --time-window sunrise-30,sunrise+180 --timezone Europe/Berlin
 
 # Test the different hyperparameters of the model
 import csv
 import datetime
 import os
-import subprocess
-import shutil
-import re
-import glob
 import pandas as pd
 import argparse
-import wave
 import traceback
 import logging
 import sys
+import audio_io
+import dedup
+import pipeline
+import staging
+from pipeline import extract_date, extract_time  # Still importable from run_birdnet
 
-# Get date from filename
-def extract_date(filename):
-    m = re.search(r'(\d{8})', filename)
-    return m.group(1) if m else None
-
-# Get time from filename
-def extract_time(filename):
-    match = re.search(r'\d{8}.*?(\d{6})(?=\D|$)', filename)
-    return match.group(1) if match else None
-
-# Combine all .csv files in the csvList into one csv file using the same headings as the first file in the list
-def combineCsv(csvList, fileName):
-    # Create a new csv file
-    with open(fileName, "w", newline='', encoding='utf-8') as f:
-        writer = csv.writer(f)
-        for i, file in enumerate(csvList):
-            with open(file, "r", newline='', encoding='utf-8') as csvfile:
-                reader = csv.reader(csvfile)
-                # Skip the header of all but the first file
-                if i != 0:
-                    next(reader, None)  # Skip the header row
-                for row in reader:
-                    writer.writerow(row)
-                    
 # Get calender week from date
 def getCalenderWeek(date):
     #date = datetime.datetime.strptime(date, "%Y-%m-%d")
     date = datetime.datetime.strptime(date, "%d/%m/%Y")
     return date.isocalendar()[1]
 
-# Return the total length of all .wav files in a folder in minutes.
-def total_wav_length(directory):
-    total_length = 0
-    for root, dirs, files in os.walk(directory):
-        for file in files:
-            if file.endswith('.wav'):
-                try:
-                    with wave.open(os.path.join(root, file), 'rb') as wav_file:
-                        frames = wav_file.getnframes()
-                        rate = wav_file.getframerate()
-                        duration = frames / float(rate)
-                        total_length += duration
-                except wave.Error:
-                    print(f"Could not open {os.path.join(root, file)} as a .wav file")
-    total_length = total_length / 60
-    return total_length
-
-# Move the combined results file to the outPath, rename it to site.csv and add a 'site' column
-def move_and_rename_results(site, tempPath, outPath):
-    # Step 1: Set the desired filename and savePath
-    filename = str(site) + ".csv"  # Filename based on the site name
-    savePath = os.path.join(outPath, filename)  # The final path to save the file
-
-    # Step 2: Search for the combined results file recursively in tempPath
-    combined_results_file = None
-    for root, dirs, files in os.walk(tempPath):
-        if "BirdNET_Kaleidoscope.csv" in files:
-            combined_results_file = os.path.join(root, "BirdNET_Kaleidoscope.csv")
-            break  # Stop searching once the file is found
-
-    # Step 3: Check if the combined results file exists
-    if combined_results_file:
-        # Step 4: Load the CSV file into a DataFrame
-        df = pd.read_csv(combined_results_file)
-
-        # Step 5: Add the 'site' column to the DataFrame
-        df['site'] = site  # Adding the site name as a column
-
-        # Step 6: Save the updated DataFrame with the new column and new filename
-        df.to_csv(savePath, index=False)
-        print(f"File saved as {savePath}")
+# Return the total length of the recordings of a header scan in minutes, leaving out the files in exclude
+def scan_minutes(scan, exclude=()):
+    return scan.loc[~scan['file'].map(os.path.normpath).isin(exclude), 'duration'].sum() / 60
+
+# Return the total length of all .wav and .flac files in a folder in minutes, leaving out the files in exclude.
+# Only the file headers are read.
+def total_wav_length(directory, exclude=()):
+    return scan_minutes(pipeline.scan_site(directory), exclude)
+
+# Check whether a file is inside a folder
+def in_folder(path, folder):
+    folder = os.path.abspath(folder)
+    return os.path.commonpath([os.path.abspath(path), folder]) == folder
+
+# Combine the site csv files in outPath into one table, including sites from earlier runs. Files in skip (full
+# paths), e.g. the combined results or the run history, are left out. Returns None if there are no site files.
+def combine_site_results(outPath, skip):
+    skip = {os.path.abspath(file) for file in skip}
+    tables = []
+    for name in sorted(os.listdir(outPath)):
+        path = os.path.join(outPath, name)
+        if not name.endswith('.csv') or os.path.abspath(path) in skip or not os.path.isfile(path):
+            continue
+        try:
+            tables.append(pd.read_csv(path, dtype={'date': str, 'timestamp': str}))
+        except pd.errors.EmptyDataError:
+            continue
+    if not tables:
+        return None
+    # Recompute date and timestamp from the file names so they stay zero padded strings
+    combined = pd.concat(tables, ignore_index=True)
+    combined['date'] = combined['IN FILE'].apply(extract_date)
+    combined['timestamp'] = combined['IN FILE'].apply(extract_time)
+    return combined
+
+# Wrap a pipeline parser as an argparse type, so its error message is shown instead of "invalid ... value"
+def argument_type(parse):
+    def parse_argument(text):
+        try:
+            return parse(text)
+        except ValueError as e:
+            raise argparse.ArgumentTypeError(str(e))
+    return parse_argument
+
+# Map a file in the folder being read (e.g. the staged copy) back to its path in the site folder
+def source_file(file, readPath, full_path):
+    return os.path.normpath(os.path.join(full_path, os.path.relpath(file, readPath)))
+
+# Get the full path of a site's recordings. path_to_recordings is relative to the users home directory.
+def site_path(row):
+    return os.path.join(os.path.expanduser("~"), row['path_to_recordings'])
+
+# Append the processing time of a site to the run history, used to estimate the runtime of later runs
+def record_throughput(historyPath, site, minutes, seconds, threads):
+    write_header = not os.path.exists(historyPath)
+    with open(historyPath, "a", newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        if write_header:
+            writer.writerow(['date', 'site', 'minutes_analysed', 'seconds', 'threads'])
+        writer.writerow([datetime.date.today().isoformat(), site, round(minutes, 2), round(seconds, 1), threads])
+
+# Return the throughput of earlier runs in minutes of audio per second, using runs with the same number of threads
+# if there are any. Returns None if there is no run history.
+def estimate_throughput(historyPath, threads):
+    if not os.path.exists(historyPath):
+        return None
+    history = pd.read_csv(historyPath)
+    history = history[history['seconds'] > 0]
+    if (history['threads'] == threads).any():
+        history = history[history['threads'] == threads]
+    if len(history) == 0:
+        return None
+    # Histories written before the column was renamed call it minutes_recorded
+    minutes = history['minutes_analysed'] if 'minutes_analysed' in history.columns else history['minutes_recorded']
+    return minutes.sum() / history['seconds'].sum()
+
+# Print the sites in processing order with their minutes of audio and, if known, their estimated runtime.
+# column is the metadata column with the minutes that will be analysed.
+def print_plan(sites, throughput, column='minutes_recorded'):
+    print(f"{'site':<30} {'audio min':>10} {'est. run min':>13}")
+    for _, row in sites.iterrows():
+        runtime = f"{row[column] / throughput / 60:.1f}" if throughput else "?"
+        print(f"{str(row['site']):<30} {row[column]:>10.1f} {runtime:>13}")
+    total = sites[column].sum()
+    print(f"Total: {len(sites)} sites, {total:.1f} minutes of audio")
+    if throughput:
+        print(f"Estimated runtime: {total / throughput / 3600:.2f} hours at {throughput * 60:.1f} audio minutes per minute")
     else:
-        print(f"Error: BirdNET_Kaleidoscope.csv not found in {tempPath} or its subfolders.")
+        print("No run history found, runtime cannot be estimated yet")
 
 # Main function
 def main():
     # Create command line arguments for inPath, outPath, metaDataPath and threads
-    parser = argparse.ArgumentParser(description="Run BirdNET on a folder of .wav files")
+    parser = argparse.ArgumentParser(description="Run BirdNET on a folder of .wav or .flac files")
     parser.add_argument("--o", type=str, help="Output folder path")
     parser.add_argument("--meta", type=str, help="Metadata csv file path")
     parser.add_argument("--threads", type=int, default=1, help="Number of threads to use")
     parser.add_argument("--min_conf", type=float, default=0.1, help="Minimum confidence threshold. Values in [0.00001, 0.99]")
-    parser.add_argument("--rtype", type=str, default="kaleidoscope", help="Specifies output format. Values in [‘table’, ‘audacity’, ‘kaleidoscope’, ‘csv’]")
     parser.add_argument("--results_name", type=str, default="birdnet_results.csv", help="Final combined results CSV file name")
+    parser.add_argument("--stage_dir", type=str, default=None, help="Local scratch folder to copy each site's recordings to before analysis, the next site is copied in the background (default: read from the DSS)")
+    parser.add_argument("--stage_max_gb", type=float, default=500, help="Maximum size of the local staging cache in GB (default: 500)")
+    parser.add_argument("--plan", action="store_true", help="Only scan the recordings and print the processing order with estimated runtimes")
+    parser.add_argument("--history", type=str, default=None, help="Run history csv used to estimate runtimes (default: run_history.csv in the output folder)")
+    parser.add_argument("--dedup", action="store_true", help="Analyse recordings with identical content only once, attach their results to every copy and write duplicates.csv")
+    parser.add_argument("--date_range", "--date-range", type=argument_type(pipeline.parse_date_range), default=None, help="Only analyse recordings from these dates, by the date in the file names, e.g. 2024-04-01,2024-06-30 (both included)")
+    parser.add_argument("--time_window", "--time-window", type=argument_type(pipeline.parse_time_window), default=None, help="Only analyse recordings that overlap this time of day, by the time in the file names. HH:MM or sunrise/sunset with an offset in minutes computed from each site's lat/lon, e.g. 04:00,09:00 or sunrise-30,sunrise+180")
+    parser.add_argument("--timezone", type=argument_type(pipeline.parse_timezone), default="UTC", help="Time zone of the times in the file names, used for sunrise/sunset windows, e.g. Europe/Berlin (default: UTC)")
+    parser.add_argument("--silence_db", type=float, default=None, help="Skip files whose loudest 3 s window is below this RMS level in dBFS, e.g. -60 (default: analyse all files)")
 
     args, unknown_args = parser.parse_known_args()
 
+    # Other arguments are passed on to BirdNET, but the results are always read in Kaleidoscope format
+    if any(arg == "--rtype" or arg.startswith("--rtype=") for arg in unknown_args):
+        parser.error("--rtype is not supported, run_birdnet.py always writes its results in Kaleidoscope format")
+
     # Set variables from command line arguments
     outPath = args.o
     metaData = args.meta
     threads = args.threads
     min_conf = args.min_conf
-    rtype = args.rtype
 
     # read metaData csv file
     metaDataList = pd.read_csv(metaData)
+
+    # Scan the file headers of every site first so the longest sites can be processed first,
+    # and optionally only keep the recordings in the requested dates and hours of the day
+    selecting = args.date_range is not None or args.time_window is not None
+    scans = {}
+    selected = {}
+    for index, row in metaDataList.iterrows():
+        scans[index] = pipeline.scan_site(site_path(row))
+        selected[index] = scans[index]
+        if selecting:
+            selected[index] = scans[index][pipeline.select_recordings(
+                scans[index], args.date_range, args.time_window, row['lat'], row['lon'], args.timezone)]
+            print(f"{row['site']}: {len(selected[index])} of {len(scans[index])} recordings selected")
+
+    # Optionally find recordings with identical content, within and across sites, among the recordings to analyse
+    duplicate_groups = []
+    duplicates = {}
+    site_of = {}
+    if args.dedup:
+        for index, row in metaDataList.iterrows():
+            for file in selected[index]['file']:
+                site_of[os.path.normpath(file)] = row['site']
+        duplicate_groups = dedup.find_duplicates(list(site_of))
+        duplicates = dedup.duplicate_map(duplicate_groups)
+        print(f"Found {len(duplicates)} duplicate recordings in {len(duplicate_groups)} groups")
+
+    # Copies of a recording, in the same or in another site, are only counted where the canonical copy is. Their
+    # minutes are reported as minutes_duplicate. With a date range or time window the effort of the selection is
+    # reported as minutes_selected and used to order and plan the sites.
+    effort = 'minutes_selected' if selecting else 'minutes_recorded'
+    for index, row in metaDataList.iterrows():
+        site_duplicates = [d for d in duplicates if in_folder(d, site_path(row))]
+        metaDataList.at[index, 'minutes_recorded'] = scan_minutes(scans[index], site_duplicates)
+        if selecting:
+            metaDataList.at[index, 'minutes_selected'] = scan_minutes(selected[index], site_duplicates)
+        if args.dedup:
+            metaDataList.at[index, 'minutes_duplicate'] = (scan_minutes(scans[index])
+                                                           - metaDataList.at[index, 'minutes_recorded'])
+    # Columns written by earlier runs with other options would be out of date
+    if not selecting:
+        metaDataList = metaDataList.drop(columns=['minutes_selected'], errors='ignore')
+    if not args.dedup:
+        metaDataList = metaDataList.drop(columns=['minutes_duplicate'], errors='ignore')
+    if args.silence_db is None:
+        metaDataList = metaDataList.drop(columns=['minutes_silent'], errors='ignore')
+    order = metaDataList[effort].sort_values(ascending=False, kind='stable').index
+    historyPath = args.history or os.path.join(outPath or ".", "run_history.csv")
+
+    # For a dry run only print the plan
+    if args.plan:
+        print_plan(metaDataList.loc[order], estimate_throughput(historyPath, threads), effort)
+        return
+    metaDataList.to_csv(metaData, index=False)
     
     # Create outPath if it doesn't exist
     if not os.path.exists(outPath):
         os.makedirs(outPath)
 
+    # Report the duplicates for the metadata owner
+    if args.dedup:
+        dedup.write_report(duplicate_groups, os.path.join(outPath, "duplicates.csv"))
+
     # Set up logging
     log_path = os.path.join(outPath, "run_output.log")
     logging.basicConfig(
@@ -143,97 +235,127 @@ def main():
         ]
     )
 
-    # Call BirdNET for every site in the metaData csv file. Every row in the file reperesents a site
-    for i, (index, row) in enumerate(metaDataList.iterrows(), start=1):
+    # Optionally copy recordings to local scratch, prefetching the next site while the current one is analysed
+    cache = None
+    if args.stage_dir:
+        cache = staging.StagingCache(args.stage_dir, int(args.stage_max_gb * 1e9))
+    # With a date range, time window or dedup only the recordings that will be analysed are staged
+    site_paths = []
+    for index, row in metaDataList.loc[order].iterrows():
+        stage_files = None
+        if selecting or args.dedup:
+            stage_files = [f for f in selected[index]['file'] if os.path.normpath(f) not in duplicates]
+        site_paths.append((site_path(row), stage_files))
+
+    # Call BirdNET for every site in the metaData csv file, longest first. Every row in the file reperesents a site
+    try:
+        for i, (index, row) in enumerate(metaDataList.loc[order].iterrows(), start=1):
         
-        try:
-            # Print and log which site of total is being processed
-            logging.info(f"Processing site {i} of {len(metaDataList)}: {row['site']}")
+            try:
+                # Print and log which site of total is being processed
+                logging.info(f"Processing site {i} of {len(metaDataList)}: {row['site']}")
 
-            # Create tempPath if it doesn't exist as the outPath plus /temp using os.path.join
-            tempPath = os.path.join(outPath, "temp")
-            if not os.path.exists(tempPath):
-                os.makedirs(tempPath)
+                # Get full path from the path_to_recordings column in the current row
+                full_path = site_path(row)
 
-            # Get path from the path_to_recordings column in the current row
-            path = row['path_to_recordings']
+                # Read from the local copy if staging is enabled. The current site is marked active before the
+                # next one is queued, so the background copy never evicts it.
+                readPath = full_path
+                if cache is not None:
+                    readPath = cache.get(*site_paths[i - 1])
+                    if i < len(site_paths):
+                        cache.prefetch(*site_paths[i])
 
-            # Get current users home directory
-            home_dir = os.path.expanduser("~")
+                # Files to analyse, None for the whole folder. Only selected recordings are analysed, and duplicates
+                # through their canonical copy.
+                files = None
+                if selecting or any(in_folder(d, full_path) for d in duplicates):
+                    selected_files = set(selected[index]['file'].map(os.path.normpath))
+                    files = [f for f in audio_io.find_audio_files(readPath)
+                             if source_file(f, readPath, full_path) not in duplicates
+                             and (not selecting or source_file(f, readPath, full_path) in selected_files)]
 
-            # Create full path
-            full_path = os.path.join(home_dir, path)
-            
-            row['minutes_recorded'] = total_wav_length(full_path)
-            # Save the DataFrame to a CSV file
-            metaDataList.at[index, 'minutes_recorded'] = total_wav_length(full_path)
-            metaDataList.to_csv(metaData, index=False)
-
-            # Get lat and lon for the current row
-            lat = row['lat']
-            lon = row['lon']
-
-            # Get start date from column start_date and get week of the year from the date
-            date = row['start_date']
-            date = datetime.datetime.strptime(date, "%d/%m/%Y")
-            date = date.strftime("%d/%m/%Y")
-            week = getCalenderWeek(date)
-            
-            # Extract site name
-            site = row['site']
-            
-            command = [
-                "python", "-m", "birdnet_analyzer.analyze",
-                full_path,
-                "-o", tempPath,
-                "--lat", str(lat),
-                "--lon", str(lon),
-                "--week", str(week),
-                "--rtype", str(rtype),
-                "--threads", str(threads), 
-                "--min_conf", str(min_conf), 
-                "--combine_results"
-            ] + unknown_args  # <-- Append any extra args
-            
-            # Join the command list into a single string for printing
-            command_str = " ".join(command)
-            
-            # Print the command as a string
-            logging.info(f"Call: {command_str}")
-            output = subprocess.check_output(command)
-            # print("Output:", output.decode("utf-8"), end='\r', flush=True)
-            logging.info(f"Output: {output.decode('utf-8')}")
+                # Optionally only analyse the files that are not silent
+                if args.silence_db is not None:
+                    active_files, silent_files, silent_minutes = pipeline.split_silent_files(readPath, args.silence_db, files=files)
+                    metaDataList.at[index, 'minutes_silent'] = silent_minutes
+                    logging.info(f"Skipping {len(silent_files)} silent files ({silent_minutes:.1f} minutes) below {args.silence_db} dBFS")
+                    if silent_files:
+                        active = set(active_files)
+                        files = active_files if files is None else [f for f in files if f in active]
+                metaDataList.to_csv(metaData, index=False)
+
+                if files is not None and not files:
+                    logging.info(f"No recordings of site {row['site']} left to analyse, skipping BirdNET")
+                    continue
+
+                # Get start date from column start_date and get week of the year from the date
+                date = row['start_date']
+                date = datetime.datetime.strptime(date, "%d/%m/%Y")
+                date = date.strftime("%d/%m/%Y")
+                week = getCalenderWeek(date)
             
-            # assuming 'date' is a string in the format dd/mm/yyyy
-            date = datetime.datetime.strptime(date, "%d/%m/%Y")
+                # Extract site name
+                site = row['site']
             
-            # Call the function to move, rename, and add 'site' column to the results
-            move_and_rename_results(site, tempPath, outPath)
-
-        except Exception as e:
-            log_file = os.path.join(outPath, "error_log.txt")
-            with open(log_file, "a") as log:
-                log.write(f"Failed processing site {row['site']} (index {index}):\n")
-                log.write(traceback.format_exc())
-                log.write("\n\n")
-            print(f"Error processing site {row['site']}. See error_log.txt for details.")
+                # Minutes of audio passed to BirdNET, for the run history
+                if files is None:
+                    minutes_analysed = scan_minutes(scans[index])
+                else:
+                    sources = {source_file(f, readPath, full_path) for f in files}
+                    minutes_analysed = scan_minutes(scans[index][scans[index]['file'].map(os.path.normpath).isin(sources)])
 
-        finally:
-            if os.path.exists(tempPath):
-                shutil.rmtree(tempPath) # Removes the directory tree of the results folder after the csv file is created
+                # Run BirdNET and save the results, with site, date and timestamp columns, as site.csv.
+                # Only BirdNET itself is timed, not staging, the silence check or dedup.
+                start_time = datetime.datetime.now()
+                df = pipeline.analyze_site(readPath, row['lat'], row['lon'], week, site=site, files=files,
+                                           threads=threads, min_conf=min_conf, extra_args=unknown_args,
+                                           source_path=full_path, work_dir=outPath)
+                seconds = (datetime.datetime.now() - start_time).total_seconds()
+                savePath = os.path.join(outPath, str(site) + ".csv")
+                df.to_csv(savePath, index=False)
+                print(f"File saved as {savePath}")
 
-    # List all the CSV files in the outPath folder with full path
-    csv_files = [os.path.join(outPath, f) for f in os.listdir(outPath) if f.endswith('.csv')]
+                # Record how long BirdNET took so later runs can be estimated with --plan
+                record_throughput(historyPath, site, minutes_analysed, seconds, threads)
 
-    # Call the combineCsv function with the list of CSV files and output file name
-    combineCsv(csv_files, os.path.join(outPath, args.results_name))
+            except Exception as e:
+                log_file = os.path.join(outPath, "error_log.txt")
+                with open(log_file, "a") as log:
+                    log.write(f"Failed processing site {row['site']} (index {index}):\n")
+                    log.write(traceback.format_exc())
+                    log.write("\n\n")
+                print(f"Error processing site {row['site']}. See error_log.txt for details.")
+    finally:
+        # Remove staged recordings, also when the run is interrupted
+        if cache is not None:
+            cache.close()
 
-    # Add date and timestamp columns based of filename
+    # Combine the results of every site in the output folder, also those of earlier runs
     results_file = os.path.join(outPath, args.results_name)
-    df = pd.read_csv(results_file)
-    df['date'] = df['IN FILE'].apply(extract_date)
-    df['timestamp'] = df['IN FILE'].apply(extract_time)
-    df.to_csv(results_file, index=False)
+    duplicates_file = os.path.join(outPath, "duplicates.csv")
+    combined = combine_site_results(outPath, [results_file, historyPath, duplicates_file])
+    if combined is None:
+        logging.info("No results to combine")
+        return
+
+    # Attach the results of each analysed recording to its duplicates and update the affected site files.
+    # Copies attached by an earlier run for the recordings checked in this run are replaced.
+    if args.dedup:
+        changed = set()
+        if 'duplicate_of' in combined.columns:
+            paths = [os.path.normpath(os.path.join(str(indir), str(folder), str(name)))
+                     for indir, folder, name in zip(combined['INDIR'], combined['FOLDER'], combined['IN FILE'])]
+            stale = combined['duplicate_of'].notna() & pd.Series(paths, index=combined.index).isin(site_of)
+            changed.update(combined.loc[stale, 'site'])
+            combined = combined[~stale]
+        combined = pipeline.attach_duplicates(combined, duplicates, site_of)
+        if 'duplicate_of' in combined.columns:
+            changed.update(combined.loc[combined['duplicate_of'].notna(), 'site'])
+        for site in changed:
+            combined[combined['site'] == site].to_csv(os.path.join(outPath, str(site) + ".csv"), index=False)
+
+    combined.to_csv(results_file, index=False)
 
     # Log saving information
     logging.info(f"Final results saved to {results_file}")
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+Local Clip Server for Validation Lists
+Serves the clips of a validation_list.csv on demand, reading only the OFFSET/DURATION region of each source file.
+Recently played clips are kept in an LRU cache.
+
+Example use:
+python3 createValidationData.py --d detections.csv --o validation --reference
+python3 serve_clips.py --list validation/validation_list.csv --port 8000
+Then open http://localhost:8000 in a browser.
+"""
+
+import argparse
+import html
+import os
+import re
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pandas as pd
+
+import audio_io
+
+CLIP_URL = re.compile(r'^/clips/(\d+)\.wav$')
+BYTE_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+def byte_range(header, size):
+    """
+    Parse a single range Range header for a body of size bytes. Returns (start, end) with end inclusive, None to
+    send the whole body, or False if the range cannot be satisfied.
+    """
+    match = BYTE_RANGE.match(header.strip()) if header else None
+    if not match or match.groups() == ('', ''):
+        # Missing, multiple or malformed ranges are answered with the whole body
+        return None
+    start, end = match.groups()
+    if start == '':
+        # Suffix range: the last end bytes
+        length = int(end)
+        if length == 0:
+            return False
+        return max(0, size - length), size - 1
+    start = int(start)
+    end = size - 1 if end == '' else min(int(end), size - 1)
+    if start >= size or end < start:
+        return False
+    return start, end
+
+def load_clips(list_file):
+    """Read a validation list and resolve the source file of every clip. Relative INDIRs are relative to the list."""
+    df = pd.read_csv(list_file)
+    base_dir = os.path.dirname(os.path.abspath(list_file))
+    df['path'] = [os.path.join(base_dir, str(indir), str(folder), str(name))
+                  for indir, folder, name in zip(df['INDIR'], df['FOLDER'], df['IN FILE'])]
+    return df
+
+def make_handler(clips, cache_size):
+    """Create a request handler serving the clips of a validation list."""
+
+    @lru_cache(maxsize=cache_size)
+    def render_clip(index):
+        clip = clips.iloc[index]
+        info, audio = audio_io.read_region(clip['path'], float(clip['OFFSET']), float(clip['DURATION']))
+        return audio_io.wav_bytes(audio, info.samplerate, info.sampwidth)
+
+    class ClipHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/':
+                self.send_body(200, 'text/html; charset=utf-8', self.index_page().encode('utf-8'))
+                return
+            match = CLIP_URL.match(self.path)
+            if not match or int(match.group(1)) >= len(clips):
+                self.send_error(404, "Clip not found")
+                return
+            try:
+                body = render_clip(int(match.group(1)))
+            except Exception as e:
+                self.send_error(500, f"Could not read clip: {e}")
+                return
+            self.send_body(200, 'audio/wav', body, self.headers.get('Range'))
+
+        def send_body(self, status, content_type, body, range_header=None):
+            # Byte ranges let the browser's audio player seek within a clip
+            content_range = None
+            if status == 200 and range_header:
+                requested = byte_range(range_header, len(body))
+                if requested is False:
+                    self.send_response(416)
+                    self.send_header('Content-Range', f"bytes */{len(body)}")
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                if requested is not None:
+                    start, end = requested
+                    status = 206
+                    content_range = f"bytes {start}-{end}/{len(body)}"
+                    body = body[start:end + 1]
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('Accept-Ranges', 'bytes')
+            if content_range:
+                self.send_header('Content-Range', content_range)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def index_page(self):
+            rows = []
+            for i, (_, clip) in enumerate(clips.iterrows()):
+                rows.append(
+                    f"<tr><td>{i}</td><td>{html.escape(str(clip.get('site', '')))}</td>"
+                    f"<td>{html.escape(str(clip.get('MANUAL ID', '')))}</td>"
+                    f"<td>{html.escape(str(clip.get('confidence', '')))}</td>"
+                    f"<td><audio controls preload=\"none\" src=\"/clips/{i}.wav\"></audio></td></tr>")
+            return ("<html><head><title>Validation clips</title></head><body>"
+                    "<table><tr><th>#</th><th>site</th><th>MANUAL ID</th><th>confidence</th><th>clip</th></tr>"
+                    + "".join(rows) + "</table></body></html>")
+
+    return ClipHandler
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the clips of a validation list on demand")
+    parser.add_argument("--list", type=str, required=True, help="validation_list.csv created by createValidationData.py")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Address to listen on (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8000, help="Port to listen on (default: 8000)")
+    parser.add_argument("--cache", type=int, default=256, help="Number of recently played clips to keep in memory (default: 256)")
+
+    args = parser.parse_args()
+
+    clips = load_clips(args.list)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(clips, args.cache))
+    print(f"Serving {len(clips)} clips on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nServer stopped")
+    finally:
+        server.server_close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+"""
+Local staging cache for recordings on the DSS.
+
+Copies the audio files of a site folder, or only the ones that will be analysed, onto local scratch (e.g. an SSD) in a background thread, so the next
+site can be copied while the current one is analysed. Staged sites are evicted least recently used first once
+the cache grows beyond its size limit. The cache only lives for one run and is removed by close().
+"""
+
+import hashlib
+import logging
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import audio_io
+
+logger = logging.getLogger(__name__)
+
+
+class StagingCache:
+    """Stage site folders under root, keeping at most max_bytes of recordings on local disk."""
+
+    def __init__(self, root, max_bytes):
+        self.root = os.path.abspath(os.path.join(root, f"toek_staging_{os.getpid()}"))
+        self.max_bytes = max_bytes
+        self._sites = OrderedDict()  # source folder -> (local folder, size in bytes), least recently used first
+        self._pending = {}  # source folder -> Future of the copy
+        self._active = None  # source folder currently being analysed, never evicted
+        self._lock = threading.Lock()
+        self._closed = threading.Event()  # set by close() to stop a copy that is running
+        # A single worker copies one site at a time, in the order they were requested
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        os.makedirs(self.root, exist_ok=True)
+
+    def prefetch(self, source, files=None):
+        """
+        Start copying a site folder in the background if it is not staged yet. If files (paths inside source) is
+        given only those files are copied.
+        """
+        source = os.path.abspath(source)
+        with self._lock:
+            if source in self._sites or source in self._pending:
+                return
+            self._pending[source] = self._executor.submit(self._stage, source, files)
+
+    def get(self, source, files=None):
+        """
+        Return the local copy of a site folder, waiting for its copy to finish. files is only used if the site
+        was not prefetched yet.
+
+        Returns the source folder itself if the site could not be staged, e.g. because it is larger than the cache.
+        """
+        source = os.path.abspath(source)
+        self.prefetch(source, files)
+        with self._lock:
+            future = self._pending.get(source)
+        if future is not None:
+            try:
+                future.result()
+            except Exception as e:
+                logger.warning(f"Could not stage {source}, reading it from the DSS ({e})")
+            with self._lock:
+                self._pending.pop(source, None)
+        with self._lock:
+            if source not in self._sites:
+                return source
+            self._sites.move_to_end(source)
+            self._active = source
+            return self._sites[source][0]
+
+    def close(self):
+        """Stop copying and remove all staged files."""
+        self._closed.set()
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def _stage(self, source, files=None):
+        files = audio_io.find_audio_files(source) if files is None else [os.path.abspath(file) for file in files]
+        if not files:
+            return
+        size = sum(os.path.getsize(file) for file in files)
+        if size > self.max_bytes:
+            logger.warning(f"{source} ({size / 1e9:.1f} GB) is larger than the staging cache, it will not be staged")
+            return
+        if not self._evict(size):
+            logger.warning(f"No room to stage {source} next to the site being analysed, it will be read from the DSS")
+            return
+
+        name = os.path.basename(source.rstrip(os.sep))
+        digest = hashlib.sha1(source.encode('utf-8')).hexdigest()[:8]
+        local = os.path.join(self.root, f"{name}_{digest}")
+        logger.info(f"Staging {len(files)} files ({size / 1e9:.1f} GB) from {source} to {local}")
+        try:
+            for file in files:
+                if self._closed.is_set():
+                    raise RuntimeError("Staging cache was closed")
+                target = os.path.join(local, os.path.relpath(file, source))
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                shutil.copy2(file, target)
+        except Exception:
+            shutil.rmtree(local, ignore_errors=True)
+            raise
+        with self._lock:
+            self._sites[source] = (local, size)
+
+    def _evict(self, size):
+        """Remove least recently used sites until size more bytes fit into the cache. Returns False if they never fit."""
+        while True:
+            with self._lock:
+                used = sum(site_size for _, site_size in self._sites.values())
+                candidates = [source for source in self._sites if source != self._active]
+                if used + size <= self.max_bytes:
+                    return True
+                if not candidates:
+                    return False
+                local, _ = self._sites.pop(candidates[0])
+            logger.info(f"Evicting {local} from the staging cache")
+            shutil.rmtree(local, ignore_errors=True)